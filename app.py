@@ -1,9 +1,15 @@
 import streamlit as st
 import pandas as pd
 import uuid
+import csv
 import io
+import json
 import os
+import re
 import shutil
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 # =============================================================================
@@ -60,17 +66,69 @@ st.markdown("""
 # =============================================================================
 # 💾 [데이터베이스 경로 및 스키마]
 # =============================================================================
+# 파일 이름은 농장(테넌트)별 데이터 폴더 기준 (tenant_path 참고)
 DB_FILE = "customer_db.csv"
 HISTORY_FILE = "order_history.csv"
 CONFIG_FILE = "config.csv"
+UNDO_FILE = "undo_log.json"
+
+# 여러 농장을 한 서버 프로세스에서 관리
+TENANT_ROOT = "farms"                       # 농장별 폴더: farms/<농장 이름>/
+DEFAULT_TENANT = "default"                  # 기본 농장은 기존처럼 현재 폴더 사용
+TENANT_NAME_PATTERN = r"[0-9a-z가-힣_-]{1,40}"       # 소문자로 맞춘 뒤 검사
+# 윈도우에서 폴더 이름으로 쓸 수 없는 장치 이름
+RESERVED_TENANT_NAMES = {"con", "prn", "aux", "nul"} | {f"{p}{i}" for p in ("com", "lpt") for i in range(1, 10)}
+MAX_CACHED_TENANTS = 8                      # 메모리에 올려둘 최대 농장 수 (LRU)
+TENANT_IDLE_SECONDS = 1800                  # 이 시간 동안 안 쓰인 농장은 캐시에서 내림
 
 REQUIRED_CUSTOMER_COLS = [
     "id", "ordered", "name", "phone", "address",
-    "qty", "memo", "sender_name", "sender_phone", "sender_addr"
+    "qty", "memo", "sender_name", "sender_phone", "sender_addr",
+    "phone_key", "addr_key", "sender_phone_key", "sender_addr_key"
+]
+
+REQUIRED_HISTORY_COLS = ["id", "date", "name", "phone", "qty", "phone_key"]
+REQUIRED_SENDER_COLS = ["name", "phone", "addr", "phone_key", "addr_key"]
+
+# 정규화 키 컬럼 (저장할 때 한 번 계산해서 파일에 같이 보관)
+CUSTOMER_KEY_COLS = ["phone_key", "addr_key", "sender_phone_key", "sender_addr_key"]
+
+# 지역번호 없이 적힌 7자리 일반전화는 제주(064)로 간주
+DEFAULT_AREA_CODE = "064"
+# 앞자리 없이 적힌 8자리 번호는 010이 빠진 휴대폰으로 간주
+DEFAULT_MOBILE_PREFIX = "010"
+
+# 주소 앞머리 시/도 약칭 → 정식 명칭 (공백을 모두 지운 뒤 적용)
+# 약칭 바로 뒤가 시/군/구면 '제주시', '광주시'처럼 다른 지명이라서 건드리지 않음
+ADDRESS_ABBREVIATIONS = [
+    (r"^서울(?:특별시|시)?(?![시군구])", "서울특별시"),
+    (r"^(부산|대구|인천|대전|울산)(?:광역시|시)?(?![시군구])", r"\1광역시"),
+    (r"^광주(?:광역시)?(?![시군구])", "광주광역시"),     # '광주시'는 경기도 광주시라서 제외
+    (r"^세종(?:특별자치시|시)?(?![시군구])", "세종특별자치시"),
+    (r"^경기(?:도)?(?![시군구])", "경기도"),
+    (r"^강원(?:특별자치도|도)?(?![시군구])", "강원특별자치도"),
+    (r"^(?:충북|충청북도)(?![시군구])", "충청북도"),
+    (r"^(?:충남|충청남도)(?![시군구])", "충청남도"),
+    (r"^(?:전북|전라북도|전북특별자치도)(?![시군구])", "전북특별자치도"),
+    (r"^(?:전남|전라남도)(?![시군구])", "전라남도"),
+    (r"^(?:경북|경상북도)(?![시군구])", "경상북도"),
+    (r"^(?:경남|경상남도)(?![시군구])", "경상남도"),
+    (r"^제주(?:특별자치도|도)?(?![시군구])", "제주특별자치도"),
+    (r"(?i)(?<![a-z])apt\.?(?![a-z])", "아파트"),
 ]
 
-REQUIRED_HISTORY_COLS = ["date", "name", "phone", "qty"]
-REQUIRED_SENDER_COLS = ["name", "phone", "addr"]
+# 되돌리기 기록 설정 (행 단위 변경분만 보관)
+UNDO_LIMIT = 30                 # 보관할 최대 작업 수
+UNDO_MAX_CELLS = 200_000        # 보관할 변경 칸 수 상한 (넘으면 오래된 작업부터 버림)
+UNDO_CUSTOMER_COLS = [c for c in REQUIRED_CUSTOMER_COLS if c != "id" and c not in CUSTOMER_KEY_COLS]
+UNDO_HISTORY_COLS = ["date", "name", "phone", "qty"]
+UNDO_SENDER_COLS = ["name", "phone", "addr"]
+
+# 백그라운드 가져오기 작업 설정
+IMPORT_WORKERS = 2              # 동시에 돌릴 가져오기 작업 수
+IMPORT_PROGRESS_EVERY = 500     # 엑셀: N행마다 진행률 갱신 + 취소 확인
+IMPORT_POLL_SECONDS = 1         # 화면에서 작업 상태를 확인하는 주기
+IMPORT_JOB_TTL_SECONDS = 3600   # 끝난 작업 결과 보관 시간
 
 # -----------------------------------------------------------------------------
 # 💾 안전 저장 유틸: temp 파일 + 백업 + 빈 DF 보호
@@ -140,6 +198,10 @@ def ensure_customer_schema(df: pd.DataFrame) -> pd.DataFrame:
     if df["id"].isna().any() or (df["id"] == "").any():
         df["id"] = df["id"].apply(lambda x: x if isinstance(x, str) and x.strip() else str(uuid.uuid4()))
 
+    # 빈 칸(NaN)은 모두 "" 로 (저장본과 편집본 비교가 어긋나지 않도록)
+    text_cols = [c for c in REQUIRED_CUSTOMER_COLS if c not in ("ordered", "qty")]
+    df[text_cols] = df[text_cols].fillna("")
+
     # 마지막으로 컬럼 순서 정리
     df = df[REQUIRED_CUSTOMER_COLS]
     return df.reset_index(drop=True)
@@ -155,6 +217,12 @@ def ensure_history_schema(df: pd.DataFrame) -> pd.DataFrame:
             else:
                 df[col] = ""
     df["qty"] = pd.to_numeric(df["qty"], errors="coerce").fillna(0).astype(int)
+    text_cols = [c for c in REQUIRED_HISTORY_COLS if c != "qty"]
+    df[text_cols] = df[text_cols].fillna("")
+
+    # 되돌리기 기록이 행을 id로 찾으므로 id가 비어 있으면 uuid 채우기
+    if df["id"].isna().any() or (df["id"] == "").any():
+        df["id"] = df["id"].apply(lambda x: x if isinstance(x, str) and x.strip() else str(uuid.uuid4()))
     return df[REQUIRED_HISTORY_COLS].reset_index(drop=True)
 
 
@@ -166,200 +234,1067 @@ def ensure_sender_schema(d: dict) -> dict:
             d[col] = ""
     return d
 
+# -----------------------------------------------------------------------------
+# 🔑 정규화 키 유틸 (전화/주소 표기 차이를 하나의 키로)
+# -----------------------------------------------------------------------------
+def canonical_phone(s: pd.Series) -> pd.Series:
+    """
+    전화번호 → 숫자만 남긴 국내 표기 키 (예: +82 10-1234-5678 → 01012345678)
+    """
+    s = s.fillna("").astype(str).str.strip()
+    # 엑셀 숫자 셀에서 온 값 (1012345678.0)
+    s = s.str.replace(r"\.0+$", "", regex=True)
+    d = s.str.replace(r"\D", "", regex=True)
+
+    # 국가번호 82 → 국내 0 접두어 (+82 10-..., 82-(0)10-...)
+    intl = d.str.startswith("82") & (d.str.len() >= 10)
+    d = d.mask(intl, "0" + d.str[2:].str.lstrip("0"))
+
+    # 엑셀이 앞자리 0을 떼어낸 번호 (1012345678 → 01012345678)
+    no_zero = ~d.str.startswith("0") & d.str.len().between(9, 10)
+    d = d.mask(no_zero, "0" + d)
+
+    # 지역번호 없이 적힌 7자리 일반전화 (712-3456)
+    local = ~d.str.startswith("0") & ~d.str.startswith("1") & (d.str.len() == 7)
+    d = d.mask(local, DEFAULT_AREA_CODE + d)
+
+    # 010이 빠진 8자리 휴대폰 (9876-5432), 15xx/16xx/18xx 대표번호는 제외
+    mobile = ~d.str.startswith("0") & ~d.str.match(r"1[568]") & (d.str.len() == 8)
+    d = d.mask(mobile, DEFAULT_MOBILE_PREFIX + d)
+    return d
+
+
+def canonical_address(s: pd.Series) -> pd.Series:
+    """
+    주소 → 비교용 키 (공백/쉼표 제거 + 시/도 약칭 통일)
+    띄어쓰기가 달라도 같은 키가 나오도록 공백부터 지우고 약칭을 바꿈
+    """
+    s = s.fillna("").astype(str).str.replace(r"[\s,]+", "", regex=True)
+    for pattern, repl in ADDRESS_ABBREVIATIONS:
+        s = s.str.replace(pattern, repl, regex=True)
+    return s
+
+
+# (키 컬럼, 원본 컬럼, 정규화 함수)
+CUSTOMER_KEY_SPECS = [
+    ("phone_key", "phone", canonical_phone),
+    ("addr_key", "address", canonical_address),
+    ("sender_phone_key", "sender_phone", canonical_phone),
+    ("sender_addr_key", "sender_addr", canonical_address),
+]
+HISTORY_KEY_SPECS = [("phone_key", "phone", canonical_phone)]
+SENDER_KEY_SPECS = [
+    ("phone_key", "phone", canonical_phone),
+    ("addr_key", "addr", canonical_address),
+]
+
+
+def refresh_keys(df: pd.DataFrame, specs, only_missing: bool = False) -> pd.DataFrame:
+    """
+    키 컬럼 전체 계산 (가져온 파일 / 예전 파일 로드용).
+    only_missing=True 이면 키가 비어 있는 행만 채움 (키 컬럼이 없던 예전 파일 로드용)
+    """
+    for key_col, src_col, canon in specs:
+        if only_missing:
+            todo = (df[key_col].fillna("") == "") & (df[src_col].fillna("").astype(str).str.strip() != "")
+            if todo.any():
+                df.loc[todo, key_col] = canon(df.loc[todo, src_col])
+        else:
+            df[key_col] = canon(df[src_col])
+    return df
+
+
+def refresh_changed_keys(df: pd.DataFrame, saved: pd.DataFrame, specs) -> pd.DataFrame:
+    """
+    저장할 때 키 갱신: 마지막 저장본(saved)과 id로 비교해서
+    원본 컬럼이 바뀐 행과 키가 비어 있는 새 행만 다시 정규화
+    """
+    prev = saved.drop_duplicates("id", keep="last").set_index("id")
+    for key_col, src_col, canon in specs:
+        old_src = df["id"].map(prev[src_col])
+        is_new_row = old_src.isna()
+        changed = ~is_new_row & (old_src.astype(str) != df[src_col].astype(str))
+        todo = changed | (is_new_row & (df[key_col].fillna("") == ""))
+        if todo.any():
+            df.loc[todo, key_col] = canon(df.loc[todo, src_col])
+    return df
+
+
+def refresh_sender_keys(d: dict) -> dict:
+    row = refresh_keys(pd.DataFrame([d]), SENDER_KEY_SPECS)
+    return row.iloc[0].to_dict()
+
+
+def customer_dedup_keys(df: pd.DataFrame) -> pd.Index:
+    """중복 판정 키: 이름 + 전화키 (전화가 없으면 주소키)"""
+    contact = df["phone_key"].where(df["phone_key"] != "", "@" + df["addr_key"])
+    return pd.Index(df["name"].astype(str).str.strip() + "|" + contact)
+
+# -----------------------------------------------------------------------------
+# ↩️ 되돌리기 / 다시 실행 (전체 복사본 대신 id 기준 행 단위 변경분만 기록)
+# -----------------------------------------------------------------------------
+def _plain(v):
+    """numpy 값 → JSON으로 저장 가능한 파이썬 값"""
+    return v.item() if hasattr(v, "item") else v
+
+
+def diff_frames(before: pd.DataFrame, after: pd.DataFrame, cols, max_cells: int = UNDO_MAX_CELLS):
+    """
+    id 기준 변경분:
+      - added / removed: 추가·삭제된 행 전체
+      - changed: 수정된 행의 바뀐 칸만 [이전값, 새값]
+    바뀐 칸 수가 max_cells를 넘으면 변경분을 만들지 않고 None 반환
+    """
+    b = before.set_index("id")[cols].fillna("")
+    a = after.set_index("id")[cols].fillna("")
+    b = b[~b.index.duplicated(keep="last")]
+    a = a[~a.index.duplicated(keep="last")]
+
+    added = a.index.difference(b.index)
+    removed = b.index.difference(a.index)
+    common = b.index.intersection(a.index)
+    bc, ac = b.loc[common], a.loc[common]
+    mask = bc.astype(str).ne(ac.astype(str))
+    mask = mask[mask.any(axis=1)]
+
+    # 큰 변경(대량 가져오기 등)은 행 dict를 만들기 전에 크기부터 확인
+    if (len(added) + len(removed)) * len(cols) + int(mask.values.sum()) > max_cells:
+        return None
+
+    # 바뀐 칸은 컬럼 단위로 모아서 (행마다 loc 하지 않음)
+    changed = {}
+    for c in cols:
+        ids = mask.index[mask[c].values]
+        if len(ids) == 0:
+            continue
+        for rid, old, new in zip(ids, bc.loc[ids, c].tolist(), ac.loc[ids, c].tolist()):
+            changed.setdefault(rid, {})[c] = [old, new]
+
+    return {
+        "added": a.loc[added].to_dict("index"),
+        "removed": b.loc[removed].to_dict("index"),
+        "changed": changed,
+    }
+
+
+def apply_change_set(touched: dict, df: pd.DataFrame, cs: dict, undo: bool):
+    """
+    변경분을 거꾸로(undo) 또는 다시(redo) 적용.
+    df(id 인덱스)는 읽기만 하고, 결과는 touched(id → 행 dict / 삭제면 None)에 쌓음.
+    비용은 이 작업이 건드린 행 수에 비례
+    """
+    drop_rows, add_rows = (cs["added"], cs["removed"]) if undo else (cs["removed"], cs["added"])
+    pick = 0 if undo else 1
+
+    for rid in drop_rows:
+        touched[rid] = None
+    for rid, cols in cs["changed"].items():
+        if rid not in touched:
+            touched[rid] = df.loc[rid].to_dict() if rid in df.index else None
+        row = touched[rid]
+        if row is not None:
+            for c, vals in cols.items():
+                row[c] = vals[pick]
+    for rid, row in add_rows.items():
+        touched[rid] = {"id": rid, **row}
+
+
+def merge_touched_rows(df: pd.DataFrame, touched: dict) -> pd.DataFrame:
+    """apply_change_set으로 쌓인 행들을 id 인덱스 df에 한 번에 반영"""
+    if not touched:
+        return df.reset_index(drop=True)
+    df = df.drop(index=[rid for rid in touched if rid in df.index])
+    rows = [row for row in touched.values() if row is not None]
+    if rows:
+        df = pd.concat([df, pd.DataFrame(rows).set_index("id", drop=False)])
+    return df.reset_index(drop=True)
+
+
+def _change_set_size(cs: dict):
+    """(건드린 행 수, 보관 중인 칸 수)"""
+    rows = len(cs["added"]) + len(cs["removed"]) + len(cs["changed"])
+    cells = (
+        sum(len(r) for r in cs["added"].values())
+        + sum(len(r) for r in cs["removed"].values())
+        + sum(len(r) for r in cs["changed"].values())
+    )
+    return rows, cells
+
+
+def load_undo_log(path: str) -> dict:
+    if os.path.exists(path):
+        try:
+            with open(path, encoding="utf-8") as f:
+                log = json.load(f)
+            return {"undo": log.get("undo", []), "redo": log.get("redo", [])}
+        except Exception as e:
+            print(f"[load_undo_log] UNDO_FILE 로드 실패: {e}")
+    return {"undo": [], "redo": []}
+
+
+def save_undo_log(log: dict, path: str):
+    tmp_path = path + ".tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(log, f, ensure_ascii=False, allow_nan=False, default=_plain)
+        os.replace(tmp_path, path)
+    except Exception as e:
+        # 되돌리기 기록 저장 실패는 본 데이터 저장을 막지 않음
+        print(f"[save_undo_log] 저장 실패: {e}")
+
+
+def record_undo_action(label: str) -> bool:
+    """
+    마지막 저장 상태와 지금 상태의 차이를 하나의 작업으로 기록.
+    반환: 기록했으면 True (바뀐 게 없으면 False)
+    """
+    s = st.session_state
+    log = s.undo_log
+    action = {
+        "label": label,
+        "time": datetime.now().strftime("%m-%d %H:%M"),
+        "df": diff_frames(s.saved_df, s.df, UNDO_CUSTOMER_COLS),
+        "history": diff_frames(s.saved_history, s.history, UNDO_HISTORY_COLS),
+        "sender": None,
+    }
+    if action["df"] is None or action["history"] is None:
+        # 상한을 넘는 변경은 보관하지 않음. 이전 기록을 이어서 되돌리면 어긋나므로 함께 비움
+        print(f"[record_undo_action] '{label}' 변경이 너무 커서 되돌리기 기록을 비움")
+        had_log = bool(log["undo"] or log["redo"])
+        log["undo"] = []
+        log["redo"] = []
+        st.toast("변경이 너무 커서 되돌리기 기록을 비웠습니다.")
+        return had_log
+
+    old_sender = {c: s.saved_sender.get(c, "") for c in UNDO_SENDER_COLS}
+    new_sender = {c: s.sender.get(c, "") for c in UNDO_SENDER_COLS}
+    if old_sender != new_sender:
+        action["sender"] = [old_sender, new_sender]
+
+    df_rows, df_cells = _change_set_size(action["df"])
+    h_rows, h_cells = _change_set_size(action["history"])
+    action["rows"] = df_rows + h_rows
+    action["cells"] = df_cells + h_cells
+    if action["rows"] == 0 and action["sender"] is None:
+        return False
+
+    log["undo"].append(action)
+    log["redo"] = []
+    # 메모리 상한: 작업 수 / 칸 수를 넘으면 오래된 작업부터 버림
+    while len(log["undo"]) > 1 and (
+        len(log["undo"]) > UNDO_LIMIT or sum(a["cells"] for a in log["undo"]) > UNDO_MAX_CELLS
+    ):
+        log["undo"].pop(0)
+    return True
+
+
+def step_undo_log(n: int, undo: bool = True) -> int:
+    """
+    최근 n개 작업을 되돌리거나(undo) 다시 실행(redo).
+    비용은 그 작업들이 건드린 행 수에 비례. 반환: 실제 처리한 작업 수
+    """
+    s = st.session_state
+    src, dst = ("undo", "redo") if undo else ("redo", "undo")
+    pick = 0 if undo else 1
+
+    # 되돌리기 기록은 같은 농장 세션끼리 공유하므로 잠금 안에서 꺼내고 저장까지 마침
+    with tenant_lock(s.tenant):
+        # id 인덱스는 한 번만 만들고, 건드린 행만 모았다가 마지막에 한 번 반영
+        df = s.df.set_index("id", drop=False)
+        hist = s.history.set_index("id", drop=False)
+        df_touched, hist_touched = {}, {}
+        sender = dict(s.sender)
+        done = 0
+        while done < n and s.undo_log[src]:
+            action = s.undo_log[src].pop()
+            apply_change_set(df_touched, df, action["df"], undo)
+            apply_change_set(hist_touched, hist, action["history"], undo)
+            if action["sender"]:
+                sender.update(action["sender"][pick])
+            s.undo_log[dst].append(action)
+            done += 1
+
+        if done:
+            df = merge_touched_rows(df, df_touched)
+            s.df = ensure_customer_schema(df).sort_values(by="name").reset_index(drop=True)
+            s.history = ensure_history_schema(merge_touched_rows(hist, hist_touched))
+            s.sender = ensure_sender_schema(sender)
+            save_all(record_undo=False)
+    return done
+
 # =============================================================================
-# 🔁 초기 상태 로드
+# 🏡 농장(테넌트) 선택 + 농장별 공유 캐시
 # =============================================================================
-def init_state():
+def normalize_tenant(tenant: str) -> str:
+    """윈도우 파일 시스템은 대소문자를 구분하지 않으므로 농장 이름은 소문자로 통일"""
+    return (tenant or "").strip().casefold()
+
+
+def is_valid_tenant(tenant: str) -> bool:
+    return (
+        bool(tenant)
+        and re.fullmatch(TENANT_NAME_PATTERN, tenant) is not None
+        and tenant not in RESERVED_TENANT_NAMES
+    )
+
+
+def tenant_dir(tenant: str) -> str:
+    if tenant == DEFAULT_TENANT:
+        return "."
+    return os.path.join(TENANT_ROOT, tenant)
+
+
+def tenant_path(tenant: str, filename: str) -> str:
+    return os.path.join(tenant_dir(tenant), filename)
+
+
+def list_tenants() -> list:
+    tenants = [DEFAULT_TENANT]
+    if os.path.isdir(TENANT_ROOT):
+        tenants += sorted({
+            normalize_tenant(t) for t in os.listdir(TENANT_ROOT)
+            if os.path.isdir(os.path.join(TENANT_ROOT, t))
+        } - {DEFAULT_TENANT})
+        tenants = [t for t in tenants if is_valid_tenant(t)]
+    return tenants
+
+
+# 농장이 바뀌면 비워야 하는 세션 작업 데이터
+# (가져오기 작업 id는 import_jobs에 농장별로 남겨서, 돌아오면 이어서 반영)
+SESSION_DATA_KEYS = [
+    "df", "history", "sender", "undo_log",
+    "saved_df", "saved_history", "saved_sender", "data_version",
+]
+
+
+def select_tenant() -> str:
+    """세션 시작 시 URL(?farm=...)로 농장 선택. 농장이 바뀌면 세션 데이터를 비움"""
+    tenant = normalize_tenant(st.query_params.get("farm", DEFAULT_TENANT))
+    if not is_valid_tenant(tenant):
+        tenant = DEFAULT_TENANT
+    if st.session_state.get("tenant") != tenant:
+        for key in SESSION_DATA_KEYS:
+            st.session_state.pop(key, None)
+        st.session_state.tenant = tenant
+    return tenant
+
+
+def load_tenant_data(tenant: str) -> dict:
+    """농장 폴더의 CSV/되돌리기 기록을 읽어서 캐시 항목으로 만듦"""
+    db_file = tenant_path(tenant, DB_FILE)
+    history_file = tenant_path(tenant, HISTORY_FILE)
+    config_file = tenant_path(tenant, CONFIG_FILE)
+
     # --- 고객 DB ---
-    if "df" not in st.session_state:
-        if os.path.exists(DB_FILE):
-            try:
-                raw = pd.read_csv(DB_FILE, dtype=str)
-                st.session_state.df = ensure_customer_schema(raw)
-            except Exception as e:
-                print(f"[init_state] DB_FILE 로드 실패: {e}")
-                st.session_state.df = ensure_customer_schema(pd.DataFrame())
-        else:
-            st.session_state.df = ensure_customer_schema(pd.DataFrame())
+    if os.path.exists(db_file):
+        try:
+            raw = pd.read_csv(db_file, dtype=str, keep_default_na=False)
+            df = refresh_keys(ensure_customer_schema(raw), CUSTOMER_KEY_SPECS, only_missing=True)
+        except Exception as e:
+            print(f"[load_tenant_data] {db_file} 로드 실패: {e}")
+            df = ensure_customer_schema(pd.DataFrame())
+    else:
+        df = ensure_customer_schema(pd.DataFrame())
 
     # --- 주문 히스토리 ---
-    if "history" not in st.session_state:
-        if os.path.exists(HISTORY_FILE):
-            try:
-                raw_h = pd.read_csv(HISTORY_FILE)
-                st.session_state.history = ensure_history_schema(raw_h)
-            except Exception as e:
-                print(f"[init_state] HISTORY_FILE 로드 실패: {e}")
-                st.session_state.history = ensure_history_schema(pd.DataFrame())
-        else:
-            st.session_state.history = ensure_history_schema(pd.DataFrame())
+    if os.path.exists(history_file):
+        try:
+            raw_h = pd.read_csv(history_file, dtype=str, keep_default_na=False)
+            history = refresh_keys(ensure_history_schema(raw_h), HISTORY_KEY_SPECS, only_missing=True)
+        except Exception as e:
+            print(f"[load_tenant_data] {history_file} 로드 실패: {e}")
+            history = ensure_history_schema(pd.DataFrame())
+    else:
+        history = ensure_history_schema(pd.DataFrame())
 
     # --- 송장 기본 설정 ---
-    if "sender" not in st.session_state:
-        if os.path.exists(CONFIG_FILE):
-            try:
-                cfg = pd.read_csv(CONFIG_FILE).iloc[0].to_dict()
-                st.session_state.sender = ensure_sender_schema(cfg)
-            except Exception as e:
-                print(f"[init_state] CONFIG_FILE 로드 실패: {e}")
-                st.session_state.sender = ensure_sender_schema({"name": "제주감귤농장", "phone": "010-0000-0000", "addr": "제주도"})
-        else:
-            st.session_state.sender = ensure_sender_schema({"name": "제주감귤농장", "phone": "010-0000-0000", "addr": "제주도"})
+    if os.path.exists(config_file):
+        try:
+            cfg = pd.read_csv(config_file, dtype=str, keep_default_na=False).iloc[0].to_dict()
+            sender = refresh_sender_keys(ensure_sender_schema(cfg))
+        except Exception as e:
+            print(f"[load_tenant_data] {config_file} 로드 실패: {e}")
+            sender = refresh_sender_keys(ensure_sender_schema({"name": "제주감귤농장", "phone": "010-0000-0000", "addr": "제주도"}))
+    else:
+        sender = refresh_sender_keys(ensure_sender_schema({"name": "제주감귤농장", "phone": "010-0000-0000", "addr": "제주도"}))
+
+    return {
+        "df": df,
+        "history": history,
+        "sender": sender,
+        "undo_log": load_undo_log(tenant_path(tenant, UNDO_FILE)),
+        "dedup_keys": None,                 # 중복 판정 인덱스 (필요할 때 계산)
+        "version": str(uuid.uuid4()),       # 저장할 때마다 바뀜 → 다른 세션이 새로 복사
+        "last_used": datetime.now(),
+        "lock": threading.RLock(),          # 저장 / 되돌리기 기록 변경은 농장 단위로 한 세션씩
+    }
+
+
+@st.cache_resource
+def get_tenant_cache():
+    """
+    서버 프로세스 전체에서 공유하는 농장별 캐시.
+    같은 농장의 세션들은 디스크를 다시 읽지 않고 여기서 복사해 감.
+    """
+    return {"tenants": OrderedDict(), "lock": threading.Lock()}
+
+
+def _evict_idle_tenants(cache: dict):
+    """LRU: 개수 상한을 넘거나 오래 안 쓰인 농장부터 캐시에서 내림 (가장 최근 것은 유지)"""
+    tenants = cache["tenants"]
+    now = datetime.now()
+    for t in list(tenants.keys())[:-1]:
+        if (now - tenants[t]["last_used"]).total_seconds() > TENANT_IDLE_SECONDS:
+            del tenants[t]
+    while len(tenants) > MAX_CACHED_TENANTS:
+        tenants.popitem(last=False)
 
-def save_all():
-    """모든 CSV를 안전하게 저장"""
-    # 항상 스키마 보정 후 저장
-    st.session_state.df = ensure_customer_schema(st.session_state.df)
-    st.session_state.history = ensure_history_schema(st.session_state.history)
-    st.session_state.sender = ensure_sender_schema(st.session_state.sender)
 
-    # DB: 기존 파일이 있을 때 empty DF로 덮어쓰지 않도록 보호
-    safe_save_csv(DB_FILE, st.session_state.df, protect_if_exists_and_empty=True)
-    safe_save_csv(HISTORY_FILE, st.session_state.history, protect_if_exists_and_empty=False)
-    # sender 설정은 DataFrame 하나 만들어서 저장
-    sender_df = pd.DataFrame([st.session_state.sender])
-    safe_save_csv(CONFIG_FILE, sender_df, protect_if_exists_and_empty=False)
+def get_tenant_data(tenant: str) -> dict:
+    cache = get_tenant_cache()
+    with cache["lock"]:
+        entry = cache["tenants"].get(tenant)
+        if entry is not None:
+            cache["tenants"].move_to_end(tenant)
+            entry["last_used"] = datetime.now()
+            return entry
 
+    # 디스크 읽기는 잠금 밖에서 (다른 농장 세션을 막지 않도록)
+    loaded = load_tenant_data(tenant)
+    with cache["lock"]:
+        entry = cache["tenants"].setdefault(tenant, loaded)
+        cache["tenants"].move_to_end(tenant)
+        entry["last_used"] = datetime.now()
+        _evict_idle_tenants(cache)
+    return entry
+
+
+def tenant_lock(tenant: str):
+    return get_tenant_data(tenant)["lock"]
+
+
+def publish_tenant_data(tenant: str):
+    """
+    저장 직후 마지막 저장본(saved_*)을 농장 캐시에 반영 (복사하지 않고 그대로 공유).
+    같은 농장의 다른 세션이 다음 실행 때 가져감
+    """
+    s = st.session_state
+    cache = get_tenant_cache()
+    version = str(uuid.uuid4())
+    with cache["lock"]:
+        entry = cache["tenants"].get(tenant)
+        if entry is None:
+            entry = {"lock": threading.RLock()}
+            cache["tenants"][tenant] = entry
+        entry.update({
+            "df": s.saved_df,
+            "history": s.saved_history,
+            "sender": s.saved_sender,
+            "undo_log": s.undo_log,
+            "dedup_keys": None,
+            "version": version,
+            "last_used": datetime.now(),
+        })
+        cache["tenants"].move_to_end(tenant)
+        _evict_idle_tenants(cache)
+    s.data_version = version
+
+
+def tenant_dedup_keys(tenant: str) -> pd.Index:
+    """농장 명단의 중복 판정 인덱스 (저장 전까지 재사용)"""
+    entry = get_tenant_data(tenant)
+    keys = entry["dedup_keys"]
+    if keys is None:
+        keys = customer_dedup_keys(entry["df"])
+        entry["dedup_keys"] = keys
+    return keys
+
+# =============================================================================
+# 🔁 초기 상태 로드
+# =============================================================================
+def init_state():
+    """
+    농장 캐시에서 세션 작업 데이터를 복사.
+    처음 들어왔거나 같은 농장의 다른 세션이 저장했으면(version 변경) 새로 복사함
+    """
+    s = st.session_state
+    entry = get_tenant_data(s.tenant)
+    if s.get("data_version") == entry["version"] and "df" in s:
+        return
+
+    s.df = entry["df"].copy()
+    s.history = entry["history"].copy()
+    s.sender = dict(entry["sender"])
+    # 되돌리기 기록은 농장 단위로 공유
+    s.undo_log = entry["undo_log"]
+
+    # 마지막 저장 상태 (변경분 계산 기준). 읽기만 하므로 캐시 것을 그대로 참조
+    s.saved_df = entry["df"]
+    s.saved_history = entry["history"]
+    s.saved_sender = entry["sender"]
+    s.data_version = entry["version"]
+
+def save_all(label: str = "변경", record_undo: bool = True):
+    """
+    현재 농장의 CSV를 모두 안전하게 저장.
+    record_undo=True 이면 마지막 저장 이후 바뀐 행들을 되돌리기 기록에 남김
+    """
+    tenant = st.session_state.tenant
+    os.makedirs(tenant_dir(tenant), exist_ok=True)
+
+    # 같은 농장의 다른 세션과 파일(.tmp 포함) / 되돌리기 기록을 동시에 건드리지 않도록 잠금
+    with tenant_lock(tenant):
+        # 항상 스키마 보정 + 정규화 키 갱신 후 저장 (바뀐 행만 다시 계산)
+        st.session_state.df = refresh_changed_keys(
+            ensure_customer_schema(st.session_state.df), st.session_state.saved_df, CUSTOMER_KEY_SPECS
+        )
+        st.session_state.history = refresh_changed_keys(
+            ensure_history_schema(st.session_state.history), st.session_state.saved_history, HISTORY_KEY_SPECS
+        )
+        st.session_state.sender = refresh_sender_keys(ensure_sender_schema(st.session_state.sender))
+
+        # DB: 기존 파일이 있을 때 empty DF로 덮어쓰지 않도록 보호
+        safe_save_csv(tenant_path(tenant, DB_FILE), st.session_state.df, protect_if_exists_and_empty=True)
+        safe_save_csv(tenant_path(tenant, HISTORY_FILE), st.session_state.history, protect_if_exists_and_empty=False)
+        # sender 설정은 DataFrame 하나 만들어서 저장
+        sender_df = pd.DataFrame([st.session_state.sender])
+        safe_save_csv(tenant_path(tenant, CONFIG_FILE), sender_df, protect_if_exists_and_empty=False)
+
+        # 되돌리기 기록 파일은 기록이 바뀐 경우에만 다시 씀 (undo/redo는 항상 바뀜)
+        log_changed = record_undo_action(label) if record_undo else True
+        if log_changed:
+            save_undo_log(st.session_state.undo_log, tenant_path(tenant, UNDO_FILE))
+
+        # 저장본은 세션과 농장 캐시가 같이 씀 (세션당 작업용 복사본 하나만 유지)
+        st.session_state.saved_df = st.session_state.df.copy()
+        st.session_state.saved_history = st.session_state.history.copy()
+        st.session_state.saved_sender = dict(st.session_state.sender)
+        publish_tenant_data(tenant)
+
+select_tenant()
 init_state()
 
 # =============================================================================
-# 🧠 [Logic] 스마트 엑셀 로더
+# 🧠 [Logic] 스마트 엑셀/CSV 로더
 # =============================================================================
-def smart_import_ai(file):
-    try:
-        df_raw = pd.read_excel(file, header=None)
-        keywords = {
-            "name": ["이름", "성함", "고객명", "받는분"],
-            "phone": ["전화", "연락처", "H.P", "Mobile", "핸드폰"],
-            "address": ["주소", "배송지"],
-            "qty": ["수량", "박스", "개수"],
-            "memo": ["비고", "메모"]
-        }
-        best_header_row = -1
-        max_matches = 0
-        column_indices = {}
-        scan_limit = min(20, len(df_raw))
-        
-        for i in range(scan_limit):
-            row_values = df_raw.iloc[i].astype(str).tolist()
-            current_matches = 0
-            current_mapping = {}
-            for col_idx, cell_value in enumerate(row_values):
-                clean_val = cell_value.replace(" ", "").replace("\n", "").lower()
-                if clean_val == "nan":
+IMPORT_KEYWORDS = {
+    "name": ["이름", "성함", "고객명", "받는분"],
+    "phone": ["전화", "연락처", "H.P", "Mobile", "핸드폰"],
+    "address": ["주소", "배송지"],
+    "qty": ["수량", "박스", "개수"],
+    "memo": ["비고", "메모"]
+}
+HEADER_SCAN_ROWS = 20
+
+DELIMITED_EXTS = (".csv", ".tsv", ".txt")
+CSV_ENCODINGS = ["utf-8-sig", "cp949"]  # cp949는 EUC-KR 상위호환
+CSV_SNIFF_BYTES = 64 * 1024
+CSV_CHUNK_ROWS = 20_000
+
+
+class ImportCancelled(Exception):
+    """백그라운드 가져오기 작업이 사용자에 의해 취소됨"""
+
+
+def detect_header(df_head: pd.DataFrame):
+    """
+    앞쪽 몇 줄에서 키워드가 가장 많이 맞는 줄을 헤더로 선택.
+    반환: (헤더 행 번호, {필드: 컬럼 번호}) / 못 찾으면 (-1, {})
+    """
+    best_header_row = -1
+    max_matches = 0
+    column_indices = {}
+    scan_limit = min(HEADER_SCAN_ROWS, len(df_head))
+
+    for i in range(scan_limit):
+        row_values = [str(v) for v in df_head.iloc[i].tolist()]
+        current_matches = 0
+        current_mapping = {}
+        for col_idx, cell_value in enumerate(row_values):
+            clean_val = cell_value.replace(" ", "").replace("\n", "").lower()
+            if clean_val == "nan":
+                continue
+            for key, synonyms in IMPORT_KEYWORDS.items():
+                if key in current_mapping:
                     continue
-                for key, synonyms in keywords.items():
-                    if key in current_mapping:
-                        continue
-                    for s in synonyms:
-                        if s.lower() in clean_val:
-                            current_mapping[key] = col_idx
-                            current_matches += 1
-                            break
-            if current_matches > max_matches and ("name" in current_mapping or "phone" in current_mapping):
-                max_matches = current_matches
-                best_header_row = i
-                column_indices = current_mapping
+                for s in synonyms:
+                    if s.lower() in clean_val:
+                        current_mapping[key] = col_idx
+                        current_matches += 1
+                        break
+        if current_matches > max_matches and ("name" in current_mapping or "phone" in current_mapping):
+            max_matches = current_matches
+            best_header_row = i
+            column_indices = current_mapping
+
+    return best_header_row, column_indices
+
+
+def extract_customers(block: pd.DataFrame, column_indices: dict) -> pd.DataFrame:
+    """헤더 아래 데이터 블록에서 고객 컬럼을 한 번에(컬럼 단위로) 추출"""
+    if "name" not in column_indices:
+        return pd.DataFrame(columns=REQUIRED_CUSTOMER_COLS)
+
+    def text(key):
+        if key not in column_indices:
+            return pd.Series("", index=block.index)
+        col = block[column_indices[key]]
+        val = col.astype(str).str.strip()
+        return val.mask(col.isna() | (val == "nan"), "")
+
+    name = text("name")
+    keep = name != ""
+    block, name = block[keep], name[keep]
+
+    if "qty" in column_indices:
+        qty = pd.to_numeric(block[column_indices["qty"]].astype(str).str.strip(), errors="coerce")
+        qty = qty.mask(qty.abs() == float("inf")).fillna(1).astype(int)
+    else:
+        qty = pd.Series(1, index=block.index)
+
+    return pd.DataFrame({
+        "id": [str(uuid.uuid4()) for _ in range(len(block))],
+        "ordered": qty > 0,
+        "name": name,
+        "phone": text("phone"),
+        "address": text("address"),
+        "qty": qty,
+        "memo": text("memo"),
+        "sender_name": "",
+        "sender_phone": "",
+        "sender_addr": ""
+    })
+
+
+def sniff_text_format(head: bytes, file_name: str):
+    """
+    파일 앞부분으로 인코딩/구분자 추정.
+    반환: (encoding, 구분자, 디코딩된 샘플 텍스트) / 실패 시 (None, None, None)
+    """
+    if head.startswith((b"\xff\xfe", b"\xfe\xff")):
+        # 엑셀 '유니코드 텍스트' 저장본
+        encoding, text = "utf-16", head.decode("utf-16", errors="ignore")
+    else:
+        encoding, text = None, None
+        for enc in CSV_ENCODINGS:
+            try:
+                text = head.decode(enc)
+            except UnicodeDecodeError as e:
+                # 샘플 끝에서 한글 글자가 잘린 경우만 허용
+                if e.start < len(head) - 3:
+                    continue
+                text = head[:e.start].decode(enc)
+            encoding = enc
+            break
+        if encoding is None:
+            return None, None, None
+
+    if file_name.lower().endswith(".tsv"):
+        sep = "\t"
+    else:
+        try:
+            sep = csv.Sniffer().sniff(text[:8192], delimiters=",\t;|").delimiter
+        except csv.Error:
+            sep = ","
+    return encoding, sep, text
+
 
+def _read_delimited_blocks(file, file_name: str):
+    """
+    CSV/TSV를 CSV_CHUNK_ROWS 줄씩 스트리밍으로 읽음 (전체를 한 번에 올리지 않음).
+    반환: (헤더 행 번호, 컬럼 매핑, 데이터 블록 제너레이터, 전체 행 수(모르면 0), 오류)
+    """
+    head = file.read(CSV_SNIFF_BYTES)
+    file.seek(0)
+    encoding, sep, text = sniff_text_format(head, file_name)
+    if encoding is None:
+        return -1, {}, None, 0, "파일 인코딩을 알 수 없습니다. (UTF-8 / CP949 / EUC-KR 지원)"
+
+    head_rows = []
+    for row in csv.reader(io.StringIO(text), delimiter=sep):
+        head_rows.append(row)
+        if len(head_rows) >= HEADER_SCAN_ROWS:
+            break
+    best_header_row, column_indices = detect_header(pd.DataFrame(head_rows))
+    if best_header_row == -1:
+        return -1, {}, None, 0, None
+    width = max(len(r) for r in head_rows)
+
+    def blocks():
+        reader = pd.read_csv(
+            file,
+            sep=sep,
+            encoding=encoding,
+            header=None,
+            names=list(range(width)),
+            index_col=False,
+            dtype=str,
+            keep_default_na=False,
+            skip_blank_lines=False,
+            on_bad_lines="skip",
+            chunksize=CSV_CHUNK_ROWS,
+        )
+        offset = 0
+        with reader:
+            for chunk in reader:
+                skip = max(0, best_header_row + 1 - offset)
+                offset += len(chunk)
+                if skip < len(chunk):
+                    yield chunk.iloc[skip:]
+
+    return best_header_row, column_indices, blocks(), 0, None
+
+
+def _read_excel_blocks(file):
+    df_raw = pd.read_excel(file, header=None)
+    best_header_row, column_indices = detect_header(df_raw)
+    if best_header_row == -1:
+        return -1, {}, None, 0, None
+
+    rows_total = len(df_raw) - (best_header_row + 1)
+    blocks = (
+        df_raw.iloc[i:i + IMPORT_PROGRESS_EVERY]
+        for i in range(best_header_row + 1, len(df_raw), IMPORT_PROGRESS_EVERY)
+    )
+    return best_header_row, column_indices, blocks, rows_total, None
+
+
+def smart_import_ai(file, file_name: str = "", existing_keys=None, on_progress=None, cancel_event=None):
+    """
+    엑셀/CSV에서 헤더 위치를 찾아 고객 명단 추출.
+      - file_name: 확장자로 CSV/TSV 여부 판단 (.csv/.tsv/.txt)
+      - existing_keys: 주면 블록마다 이 중복 판정 키에 있는 고객을 제외 (선택)
+      - on_progress(rows_parsed, rows_total, rows_deduped): 진행률 콜백 (선택, 전체 행 수를 모르면 0)
+      - cancel_event: set 되면 ImportCancelled 발생 (선택)
+    """
+    try:
+        if file_name.lower().endswith(DELIMITED_EXTS):
+            best_header_row, column_indices, blocks, rows_total, err = _read_delimited_blocks(file, file_name)
+        else:
+            best_header_row, column_indices, blocks, rows_total, err = _read_excel_blocks(file)
+        if err:
+            return None, err
         if best_header_row == -1:
             return None, "데이터 시작 위치를 찾지 못했습니다."
 
-        extracted_data = []
-        for i in range(best_header_row + 1, len(df_raw)):
-            row = df_raw.iloc[i]
-            try:
-                raw_name = str(row[column_indices["name"]])
-            except KeyError:
-                continue
-
-            if raw_name == "nan" or raw_name.strip() == "":
-                continue
-            name = raw_name.strip()
-
-            phone = ""
-            if "phone" in column_indices:
-                phone = str(row[column_indices["phone"]]).strip()
-                if phone == "nan":
-                    phone = ""
-
-            address = ""
-            if "address" in column_indices:
-                address = str(row[column_indices["address"]]).strip()
-                if address == "nan":
-                    address = ""
-
-            memo = ""
-            if "memo" in column_indices:
-                memo = str(row[column_indices["memo"]]).strip()
-                if memo == "nan":
-                    memo = ""
-
-            qty = 1
-            if "qty" in column_indices:
-                try:
-                    qty_val = row[column_indices["qty"]]
-                    qty = int(float(qty_val))
-                except Exception:
-                    qty = 1
-            
-            item = {
-                "id": str(uuid.uuid4()),
-                "ordered": (qty > 0),
-                "name": name,
-                "phone": phone,
-                "address": address,
-                "qty": qty,
-                "memo": memo,
-                "sender_name": "",
-                "sender_phone": "",
-                "sender_addr": ""
-            }
-            extracted_data.append(item)
-
-        if not extracted_data:
+        extracted = []
+        rows_parsed = 0
+        rows_found = 0
+        rows_deduped = 0
+        for block in blocks:
+            if cancel_event is not None and cancel_event.is_set():
+                raise ImportCancelled()
+            part = extract_customers(block, column_indices)
+            if not part.empty:
+                rows_found += len(part)
+                part = refresh_keys(ensure_customer_schema(part), CUSTOMER_KEY_SPECS)
+                if existing_keys is not None:
+                    is_new = ~customer_dedup_keys(part).isin(existing_keys)
+                    rows_deduped += int((~is_new).sum())
+                    part = part[is_new]
+                if not part.empty:
+                    extracted.append(part)
+            rows_parsed += len(block)
+            if on_progress is not None:
+                on_progress(rows_parsed, rows_total, rows_deduped)
+
+        if rows_found == 0:
             return None, "추출할 데이터가 없습니다."
+        if not extracted:
+            # 전부 이미 등록된 고객
+            return ensure_customer_schema(pd.DataFrame()), None
 
-        new_df = pd.DataFrame(extracted_data)
-        new_df = ensure_customer_schema(new_df)
+        new_df = ensure_customer_schema(pd.concat(extracted, ignore_index=True))
         return new_df, None
+    except ImportCancelled:
+        raise
     except Exception as e:
         return None, f"분석 오류: {str(e)}"
 
+# =============================================================================
+# ⏳ [Logic] 백그라운드 가져오기 작업 (진행률 / 취소 / 결과 보관)
+# =============================================================================
+@st.cache_resource
+def get_import_pool():
+    """
+    서버 프로세스 전체에서 공유하는 작업 풀.
+    세션(휴대폰 연결)이 끊겨도 작업과 결과는 여기 남아 있음.
+    """
+    return {
+        "executor": ThreadPoolExecutor(max_workers=IMPORT_WORKERS, thread_name_prefix="import"),
+        "jobs": {},
+        "lock": threading.Lock(),
+    }
+
+
+def _prune_import_jobs(pool: dict):
+    """끝난 지 오래된 작업 결과는 정리 (pool["lock"] 안에서 호출)"""
+    now = datetime.now()
+    for jid in [
+        jid for jid, j in pool["jobs"].items()
+        if j["finished_at"] is not None and (now - j["finished_at"]).total_seconds() > IMPORT_JOB_TTL_SECONDS
+    ]:
+        del pool["jobs"][jid]
+
+
+def get_import_job(job_id: str):
+    if not job_id:
+        return None
+    pool = get_import_pool()
+    with pool["lock"]:
+        _prune_import_jobs(pool)
+        return pool["jobs"].get(job_id)
+
+
+def run_import_job(job: dict, data: bytes, existing_keys: pd.Index):
+    """작업 스레드 본체: 블록 단위 파싱 + 중복 제거 → 결과 보관"""
+    with job["lock"]:
+        if job["cancel"].is_set() or job["status"] == "cancelled":
+            job["status"] = "cancelled"
+            job["finished_at"] = job["finished_at"] or datetime.now()
+            return
+        job["status"] = "running"
+
+    def on_progress(rows_parsed, rows_total, rows_deduped):
+        job["rows_parsed"] = rows_parsed
+        job["rows_total"] = rows_total
+        job["rows_deduped"] = rows_deduped
+
+    try:
+        # 중복 제거 (이름+정규화 키 기준, 제출 시점의 명단과 비교)는 블록마다 진행
+        add_df, err = smart_import_ai(
+            io.BytesIO(data), job["file_name"], existing_keys=existing_keys,
+            on_progress=on_progress, cancel_event=job["cancel"]
+        )
+        if err:
+            job["error"] = err
+            job["status"] = "error"
+            return
+
+        if job["cancel"].is_set():
+            job["status"] = "cancelled"
+            return
+        job["result"] = add_df
+        job["status"] = "done"
+    except ImportCancelled:
+        job["status"] = "cancelled"
+    except Exception as e:
+        job["error"] = f"작업 오류: {str(e)}"
+        job["status"] = "error"
+    finally:
+        job["finished_at"] = datetime.now()
+
+
+def submit_import_job(tenant: str, file_name: str, data: bytes, existing_keys: pd.Index) -> str:
+    pool = get_import_pool()
+    job = {
+        "id": str(uuid.uuid4()),
+        "tenant": tenant,
+        "file_name": file_name,
+        "status": "queued",
+        "rows_parsed": 0,
+        "rows_total": 0,
+        "rows_deduped": 0,
+        "result": None,
+        "error": None,
+        "cancel": threading.Event(),
+        "lock": threading.Lock(),           # 대기 중 취소와 작업 시작이 엇갈리지 않도록
+        "finished_at": None,
+    }
+    with pool["lock"]:
+        _prune_import_jobs(pool)
+        pool["jobs"][job["id"]] = job
+    pool["executor"].submit(run_import_job, job, data, existing_keys)
+    return job["id"]
+
+
+def commit_import_job(job_id: str):
+    """
+    끝난 작업의 결과를 명단에 한 번에 합침.
+    작업 중에 명단이 바뀌었을 수 있으므로 현재 명단 기준으로 한 번 더 중복 제거.
+    반환: (추가된 인원 수, 중복으로 제외된 인원 수) / 이미 반영됐거나 결과가 없으면 None
+    """
+    pool = get_import_pool()
+    with pool["lock"]:
+        _prune_import_jobs(pool)
+        job = pool["jobs"].get(job_id)
+        if job is None or job["status"] != "done" or job["tenant"] != st.session_state.tenant:
+            return None
+        # 반영 중 표시만 하고 결과는 저장이 끝날 때까지 남겨둠
+        job["status"] = "committing"
+        add_df = job["result"]
+        rows_deduped = job["rows_deduped"]
+
+    prev_df = st.session_state.df
+    try:
+        base_df = ensure_customer_schema(st.session_state.df.copy())
+        is_new = ~customer_dedup_keys(add_df).isin(tenant_dedup_keys(st.session_state.tenant))
+        rows_deduped += int((~is_new).sum())
+        add_df = add_df[is_new]
+        if not add_df.empty:
+            merged = pd.concat([base_df, add_df], ignore_index=True)
+            merged = ensure_customer_schema(merged)
+            st.session_state.df = merged.sort_values(by="name").reset_index(drop=True)
+            save_all("엑셀 가져오기")
+    except Exception:
+        # 저장 실패: 명단은 되돌리고 결과는 그대로 두어 다음 실행 때 다시 반영 시도
+        st.session_state.df = prev_df
+        with pool["lock"]:
+            job["status"] = "done"
+        raise
+
+    with pool["lock"]:
+        job["status"] = "committed"
+        job["result"] = None
+    return len(add_df), rows_deduped
+
+
+def get_active_import_job_id():
+    """현재 농장에서 이 세션이 진행 중인 가져오기 작업 id (농장별로 따로 보관)"""
+    return st.session_state.get("import_jobs", {}).get(st.session_state.tenant)
+
+
+def set_active_import_job(job_id: str):
+    st.session_state.setdefault("import_jobs", {})[st.session_state.tenant] = job_id
+    st.query_params["job"] = job_id
+
+
+def clear_active_import_job():
+    st.session_state.get("import_jobs", {}).pop(st.session_state.tenant, None)
+    if "job" in st.query_params:
+        del st.query_params["job"]
+
+
+@st.fragment(run_every=IMPORT_POLL_SECONDS)
+def import_job_panel(job_id: str):
+    """진행 중인 작업 상태를 주기적으로 다시 그림 (페이지 전체는 멈추지 않음)"""
+    job = get_import_job(job_id)
+    if job is None or job["status"] not in ("queued", "running"):
+        # 끝났으면 전체 화면을 다시 돌려서 결과를 반영
+        st.rerun()
+
+    st.caption(f"📄 {job['file_name']}")
+    if job["status"] == "queued":
+        st.progress(0.0, text="대기 중...")
+    elif job["rows_total"]:
+        st.progress(
+            min(job["rows_parsed"] / job["rows_total"], 1.0),
+            text=f"읽은 행 {job['rows_parsed']:,} / {job['rows_total']:,} · 중복 {job['rows_deduped']:,}",
+        )
+    else:
+        # CSV는 스트리밍으로 읽어서 전체 행 수를 미리 알 수 없음
+        st.caption(f"읽은 행 {job['rows_parsed']:,} · 중복 {job['rows_deduped']:,}")
+    if st.button("⏹️ 취소", key=f"cancel_{job_id}"):
+        with job["lock"]:
+            job["cancel"].set()
+            # 아직 대기 중이면 작업 스레드를 기다리지 않고 바로 취소 처리
+            if job["status"] == "queued":
+                job["status"] = "cancelled"
+                job["finished_at"] = datetime.now()
+        st.rerun()
+
 # =============================================================================
 # 🖥️ [UI] 메인 화면
 # =============================================================================
 st.title("🍊 감귤 농장")
 
+# --- 농장 선택 (사이드바) ---
+with st.sidebar:
+    st.subheader("🏡 농장")
+    current_tenant = st.session_state.tenant
+    farms = list_tenants()
+    if current_tenant not in farms:
+        farms.append(current_tenant)
+    picked = st.selectbox(
+        "농장 선택",
+        farms,
+        index=farms.index(current_tenant),
+        format_func=lambda t: "기본 농장" if t == DEFAULT_TENANT else t,
+    )
+    with st.form("new_farm"):
+        new_farm = st.text_input("새 농장 이름")
+        if st.form_submit_button("➕ 농장 추가"):
+            new_farm = normalize_tenant(new_farm)
+            if is_valid_tenant(new_farm):
+                try:
+                    os.makedirs(tenant_dir(new_farm), exist_ok=True)
+                    picked = new_farm
+                except OSError as e:
+                    print(f"[farm] {new_farm} 폴더 생성 실패: {e}")
+                    st.warning("농장 폴더를 만들 수 없습니다. 다른 이름을 입력해주세요.")
+            else:
+                st.warning("한글/영문/숫자/-/_ 로 40자 이내로 입력해주세요.")
+
+    # 다른 농장에서 돌려둔 가져오기는 계속 진행되고, 그 농장으로 돌아가면 반영됨
+    for farm, farm_job_id in st.session_state.get("import_jobs", {}).items():
+        farm_job = get_import_job(farm_job_id)
+        if farm != current_tenant and farm_job is not None and farm_job["status"] in ("queued", "running", "done"):
+            farm_label = "기본 농장" if farm == DEFAULT_TENANT else farm
+            st.caption(f"⏳ {farm_label}: '{farm_job['file_name']}' 가져오기 대기 중 (돌아가면 반영)")
+    if picked != current_tenant:
+        if picked == DEFAULT_TENANT:
+            if "farm" in st.query_params:
+                del st.query_params["farm"]
+        else:
+            st.query_params["farm"] = picked
+        if "job" in st.query_params:
+            del st.query_params["job"]
+        st.rerun()
+
+if st.session_state.tenant != DEFAULT_TENANT:
+    st.caption(f"🏡 {st.session_state.tenant}")
+
+undo_log = st.session_state.undo_log
+u1, u2 = st.columns(2)
+if u1.button("↩️ 되돌리기", disabled=not undo_log["undo"], use_container_width=True):
+    step_undo_log(1, undo=True)
+    st.rerun()
+if u2.button("↪️ 다시 실행", disabled=not undo_log["redo"], use_container_width=True):
+    step_undo_log(1, undo=False)
+    st.rerun()
+
 tab1, tab2, tab3, tab4 = st.tabs(["📋 명단", "🚚 주문", "📊 통계", "⚙️ 설정"])
 
 # --- Tab 1: 고객 관리 ---
 with tab1:
-    with st.expander("📂 엑셀 불러오기 (Smart)", expanded=True):
-        up_file = st.file_uploader("엑셀 업로드", type=["xlsx", "xls", "xlsm"])
-        if up_file:
-            if st.button("합치기", type="primary"):
-                new_df, err = smart_import_ai(up_file)
-                if err:
-                    st.error(err)
+    with st.expander("📂 엑셀/CSV 불러오기 (Smart)", expanded=True):
+        # 연결이 끊겼다가 다시 들어와도 URL(?job=...)로 작업을 이어서 확인
+        job_id = get_active_import_job_id()
+        if job_id is None and "job" in st.query_params:
+            job_id = st.query_params["job"]
+        if job_id:
+            set_active_import_job(job_id)
+        job = get_import_job(job_id)
+        if job_id and (job is None or job["tenant"] != st.session_state.tenant):
+            # 서버 재시작 등으로 작업이 사라졌거나 다른 농장의 작업
+            clear_active_import_job()
+        elif job is not None:
+            if job["status"] in ("queued", "running"):
+                import_job_panel(job_id)
+            elif job["status"] == "done":
+                committed = commit_import_job(job_id)
+                clear_active_import_job()
+                added, deduped = committed if committed else (0, 0)
+                if added:
+                    st.success(f"{added}명 추가! (중복 {deduped}명 제외)")
                 else:
-                    # 중복 제거 (name+phone 기준)
-                    base_df = ensure_customer_schema(st.session_state.df.copy())
-                    existing_keys = set(zip(base_df["name"], base_df["phone"]))
-                    filtered_rows = [
-                        r for _, r in new_df.iterrows()
-                        if (r["name"], r["phone"]) not in existing_keys
-                    ]
-
-                    if filtered_rows:
-                        add_df = pd.DataFrame(filtered_rows)
-                        merged = pd.concat([base_df, add_df], ignore_index=True)
-                        merged = ensure_customer_schema(merged)
-                        st.session_state.df = merged.sort_values(by="name").reset_index(drop=True)
-                        save_all()
-                        st.success(f"{len(filtered_rows)}명 추가!")
-                    else:
-                        st.warning("이미 등록된 고객입니다.")
-                    st.rerun()
+                    st.warning(f"이미 등록된 고객입니다. (중복 {deduped}명)")
+            elif job["status"] == "error":
+                st.error(job["error"])
+                clear_active_import_job()
+            elif job["status"] == "cancelled":
+                st.info("가져오기를 취소했습니다.")
+                clear_active_import_job()
+            else:
+                clear_active_import_job()
+
+        up_file = st.file_uploader("엑셀/CSV 업로드", type=["xlsx", "xls", "xlsm", "csv", "tsv", "txt"])
+        if up_file and get_active_import_job_id() is None:
+            if st.button("합치기", type="primary"):
+                existing_keys = tenant_dedup_keys(st.session_state.tenant)
+                job_id = submit_import_job(st.session_state.tenant, up_file.name, up_file.getvalue(), existing_keys)
+                set_active_import_job(job_id)
+                st.rerun()
 
     with st.expander("➕ 직접 등록"):
         with st.form("new"):
@@ -389,7 +1324,7 @@ with tab1:
                     df = ensure_customer_schema(df)
                     df = df.sort_values(by="name").reset_index(drop=True)
                     st.session_state.df = df
-                    save_all()
+                    save_all("직접 등록")
                     st.success("등록 완료!")
                     st.rerun()
                 else:
@@ -404,7 +1339,7 @@ with tab1:
             df["ordered"] = False
             df["qty"] = 0
             st.session_state.df = df
-            save_all()
+            save_all("체크 해제")
             st.toast("초기화됨")
             st.rerun()
 
@@ -424,7 +1359,8 @@ with tab1:
             "sender_name": None,
             "sender_phone": None,
             "sender_addr": None,
-            "id": None
+            "id": None,
+            **{col: None for col in CUSTOMER_KEY_COLS},
         },
         hide_index=True,
         use_container_width=True,
@@ -456,7 +1392,7 @@ with tab1:
         edited_df = edited_df.sort_values(by="name").reset_index(drop=True)
 
         st.session_state.df = edited_df
-        save_all()
+        save_all("명단 편집")
         st.rerun()
 
 # --- Tab 2: 주문 현황 ---
@@ -479,7 +1415,8 @@ with tab2:
                 "ordered": None,
                 "sender_name": None,
                 "sender_phone": None,
-                "sender_addr": None
+                "sender_addr": None,
+                **{col: None for col in CUSTOMER_KEY_COLS},
             },
             use_container_width=True,
             hide_index=True,
@@ -502,13 +1439,14 @@ with tab2:
 
             base_df = ensure_customer_schema(base_df)
             st.session_state.df = base_df
-            save_all()
+            save_all("주문 편집")
             st.rerun()
 
         st.divider()
         if st.button("🏁 주문 마감 (저장&리셋)", type="primary"):
-            record = orders[["name", "phone", "qty"]].copy()
+            record = orders[["name", "phone", "phone_key", "qty"]].copy()
             record["date"] = datetime.now().strftime("%Y-%m-%d")
+            record["id"] = [str(uuid.uuid4()) for _ in range(len(record))]
             hist = ensure_history_schema(st.session_state.history.copy())
             hist = pd.concat([hist, record[REQUIRED_HISTORY_COLS]], ignore_index=True)
             st.session_state.history = ensure_history_schema(hist)
@@ -518,7 +1456,7 @@ with tab2:
             df_reset["qty"] = 0
             st.session_state.df = df_reset
 
-            save_all()
+            save_all("주문 마감")
             st.success("마감 완료!")
             st.rerun()
     else:
@@ -531,15 +1469,15 @@ with tab3:
     c1.subheader("🏆 VIP")
     if c2.button("🗑️ 전체 기록 삭제"):
         st.session_state.history = ensure_history_schema(pd.DataFrame())
-        save_all()
+        save_all("전체 기록 삭제")
         st.rerun()
 
     if not st.session_state.history.empty:
+        # 같은 사람의 전화 표기가 달라도 정규화 키로 묶어서 합산
         stats = (
-            st.session_state.history.groupby(["name", "phone"])["qty"]
-            .sum()
-            .reset_index()
-        )
+            st.session_state.history.groupby(["name", "phone_key"], as_index=False)
+            .agg(phone=("phone", "last"), qty=("qty", "sum"))
+        )[["name", "phone", "qty"]]
         stats = stats.sort_values(by="qty", ascending=False).reset_index(drop=True)
         stats.index += 1
         st.dataframe(
@@ -564,9 +1502,20 @@ with tab4:
             sa = st.text_input("주소", st.session_state.sender["addr"])
             if st.form_submit_button("저장"):
                 st.session_state.sender = ensure_sender_schema({"name": sn, "phone": sp, "addr": sa})
-                save_all()
+                save_all("기본 정보 저장")
                 st.success("저장됨")
 
+    with st.expander("🕘 변경 기록"):
+        if undo_log["undo"]:
+            for a in reversed(undo_log["undo"][-10:]):
+                st.caption(f"{a['time']} · {a['label']} ({a['rows']}행)")
+            n_undo = st.number_input("되돌릴 개수", min_value=1, max_value=len(undo_log["undo"]), value=1)
+            if st.button("↩️ 선택한 만큼 되돌리기"):
+                step_undo_log(int(n_undo), undo=True)
+                st.rerun()
+        else:
+            st.info("기록 없음")
+
     st.divider()
     st.write("📄 송장 편집")
     
@@ -579,6 +1528,8 @@ with tab4:
             ("sender_name", def_s["name"]),
             ("sender_phone", def_s["phone"]),
             ("sender_addr", def_s["addr"]),
+            ("sender_phone_key", def_s["phone_key"]),
+            ("sender_addr_key", def_s["addr_key"]),
         ]:
             orders_active[col] = orders_active[col].replace("", pd.NA).fillna(def_val)
 
@@ -628,21 +1579,24 @@ with tab4:
                     ].values
 
             st.session_state.df = ensure_customer_schema(base_df)
-            save_all()
+            save_all("송장 편집")
             st.rerun()
 
         st.markdown("---")
         st.write("👀 미리보기")
         
-        grouped = edited_inv.groupby(["sender_name", "sender_phone", "sender_addr"])
-        for (s_name, s_phone, s_addr), group in grouped:
+        # 보내는 사람 전화/주소 표기가 달라도 정규화 키가 같으면 한 묶음
+        grouped = edited_inv.groupby(["sender_name", "sender_phone_key", "sender_addr_key"])
+        for (s_name, s_phone_key, s_addr_key), group in grouped:
+            s_phone = group["sender_phone"].iloc[0]
+            s_addr = group["sender_addr"].iloc[0]
             st.markdown(
                 f"<div class='sender-header'>📤 {s_name} ({s_phone})<br>"
                 f"<span style='font-size:0.8em; font-weight:normal;'>{s_addr}</span></div>",
                 unsafe_allow_html=True,
             )
             
-            group_key = f"preview_{s_name}_{s_phone}"
+            group_key = f"preview_{s_name}_{s_phone_key}_{s_addr_key}"
             edited_group = st.data_editor(
                 group[["name", "phone", "address", "qty", "memo"]],
                 column_config={
@@ -664,7 +1618,7 @@ with tab4:
                     if mask.any():
                         base_df.loc[mask, "memo"] = row["memo"]
                 st.session_state.df = ensure_customer_schema(base_df)
-                save_all()
+                save_all("메모 편집")
                 st.rerun()
 
         def to_excel(df: pd.DataFrame):